@@ -18,7 +18,6 @@ from typing import List, Optional, Tuple, Union
 import torch
 import torch.utils.checkpoint
 from torch import nn
-from torch.nn import CrossEntropyLoss
 
 from transformers.activations import ACT2FN
 from transformers.modeling_outputs import (
@@ -34,7 +33,7 @@ from transformers.utils import (
 )
 from transformers.models.gpt_bigcode.configuration_gpt_bigcode import GPTBigCodeConfig
 
-from flash_attn.flash_attn_interface import flash_attn_unpadded_kvpacked_func
+from flash_attn.flash_attn_interface import flash_attn_varlen_kvpacked_func
 from flash_attn.bert_padding import pad_input, unpad_input
 
 
@@ -175,7 +174,7 @@ class GPTBigCodeAttention(nn.Module):
         assert not output_attentions, "output_attentions is not supported."
 
         is_causal = T > 1  # T == 1 (decoding) do not need causal mask.
-        attn_output = flash_attn_unpadded_kvpacked_func(
+        attn_output = flash_attn_varlen_kvpacked_func(
             q=unpadded_q, kv=unpadded_kv,
             cu_seqlens_q=cu_seqlens_q, cu_seqlens_k=cu_seqlens_kv,
             max_seqlen_q=max_seqlen_q, max_seqlen_k=max_seqlen_kv,
@@ -769,8 +768,7 @@ class GPTBigCodeForCausalLM(GPTBigCodePreTrainedModel):
             shift_logits = lm_logits[..., :-1, :].contiguous()
             shift_labels = labels[..., 1:].contiguous().to(shift_logits.device)
             # Flatten the tokens
-            loss_fct = CrossEntropyLoss()
-            loss = loss_fct(shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1))
+            loss = nn.functional.cross_entropy(shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1))
 
         if not return_dict:
             output = (lm_logits,) + transformer_outputs[1:]
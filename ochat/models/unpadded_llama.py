@@ -20,31 +20,86 @@
 """ PyTorch Unpadded & Fused LLaMA model. Compatible with HF. """
 
 from typing import Optional, Tuple
+from dataclasses import dataclass
 
 import torch
 import torch.utils.checkpoint
 from torch import nn
-from torch.nn import CrossEntropyLoss
 
-from transformers.activations import ACT2FN
 from transformers.modeling_outputs import CausalLMOutputWithPast
 from transformers.modeling_utils import PreTrainedModel
 from transformers.utils import logging
 from transformers.models.llama.configuration_llama import LlamaConfig
 
-from flash_attn.flash_attn_interface import flash_attn_unpadded_func
-from flash_attn.bert_padding import pad_input
+from flash_attn.flash_attn_interface import flash_attn_varlen_qkvpacked_func
+from flash_attn.bert_padding import pad_input, unpad_input
+from flash_attn.ops.triton.rotary import apply_rotary
+
+try:
+    # Fused RMSNorm kernel, requires flash-attn built with the dropout_layer_norm extension.
+    # Streams each row once with fp32 accumulation instead of 5 separate elementwise/reduction kernels.
+    from flash_attn.ops.rms_norm import rms_norm as fused_rms_norm
+    from flash_attn.ops.rms_norm import dropout_add_rms_norm as fused_add_rms_norm
+except ImportError:
+    fused_rms_norm     = None
+    fused_add_rms_norm = None
+
+if hasattr(torch, "compiler"):
+    # Dynamo cannot trace the flash-attn extension ops; run them eagerly inside compiled graphs
+    flash_attn_varlen_qkvpacked_func = torch.compiler.disable(flash_attn_varlen_qkvpacked_func)
+    apply_rotary           = torch.compiler.disable(apply_rotary)
+    if fused_rms_norm is not None:
+        fused_rms_norm     = torch.compiler.disable(fused_rms_norm)
+        fused_add_rms_norm = torch.compiler.disable(fused_add_rms_norm)
 
 
 logger = logging.get_logger(__name__)
 
 
+@dataclass
+class UnpaddedCausalLMOutput(CausalLMOutputWithPast):
+    # Unpad layout for mapping the [nnz, vocab] logits back to batch/sequence positions
+    indices:    Optional[torch.Tensor] = None
+    cu_seqlens: Optional[torch.Tensor] = None
+    max_seqlen: Optional[int] = None
+
+
+@torch.jit.script
+def swiglu(gate: torch.Tensor, up: torch.Tensor):
+    return torch.nn.functional.silu(gate) * up
+
+
 @torch.jit.script
-def weighted_cross_entropy(logits: torch.Tensor, labels: torch.Tensor, weights: torch.Tensor):
-    factor = weights.sum()
+def chunked_cross_entropy(hidden_states: torch.Tensor, lm_head_weight: torch.Tensor,
+                          labels: torch.Tensor, weights: Optional[torch.Tensor],
+                          chunk_size: int = 4096):
+    """lm_head + cross entropy, chunked along the token dimension.
+
+    Avoids holding the full [nnz, vocab] logits and its fp32 log-softmax at the
+    same time: only one [chunk_size, vocab] logits slice is live per iteration,
+    roughly halving the loss-path activation peak. Note that under autograd each
+    chunk's softmax is still saved for backward, so ~one [nnz, vocab] tensor in
+    total remains resident until the backward pass; eliminating that as well
+    would require recomputing chunks in backward (fused-linear-CE style)."""
+
+    # Normalization factor in fp32, matching the fp32 loss accumulation
+    if weights is not None:
+        factor = weights.sum().float()
+    else:
+        factor = (labels != -100).sum().to(torch.float32)
     factor = torch.where(factor == 0, 0, torch.reciprocal(factor))  # Avoid NaNs
 
-    return factor * (weights * torch.nn.functional.cross_entropy(logits, labels, reduction="none")).sum()
+    loss_sum = torch.zeros((), dtype=torch.float32, device=hidden_states.device)
+    for start in range(0, hidden_states.shape[0], chunk_size):
+        logits_chunk = torch.nn.functional.linear(hidden_states[start: start + chunk_size], lm_head_weight)
+        loss_chunk   = torch.nn.functional.cross_entropy(logits_chunk, labels[start: start + chunk_size], reduction="none")
+
+        if weights is not None:
+            loss_chunk = weights[start: start + chunk_size] * loss_chunk
+
+        loss_sum = loss_sum + loss_chunk.sum()
+
+    return factor * loss_sum
 
 
 class UnpaddedLlamaRMSNorm(nn.Module):
@@ -58,15 +113,53 @@ class UnpaddedLlamaRMSNorm(nn.Module):
         self.variance_epsilon = eps
 
     def forward(self, hidden_states):
+        if fused_rms_norm is not None and hidden_states.is_cuda:
+            return fused_rms_norm(hidden_states, self.weight, self.variance_epsilon)
+
         input_dtype = hidden_states.dtype
-        variance = hidden_states.to(torch.float32).pow(2).mean(-1, keepdim=True)
+        # vector_norm upcasts inside the reduction: fp32 sum-of-squares in a single kernel,
+        # with no fp32 copy of the input and no overflow-prone fp16 x^2 intermediate
+        variance = torch.linalg.vector_norm(hidden_states, dim=-1, keepdim=True, dtype=torch.float32).square() \
+                   / hidden_states.shape[-1]
         hidden_states = hidden_states * torch.rsqrt(variance + self.variance_epsilon)
 
         return (self.weight * hidden_states).to(input_dtype)
 
 
+def add_rms_norm(hidden_states, residual, norm: UnpaddedLlamaRMSNorm):
+    # Fused residual-add + RMSNorm (prenorm): streams both tensors once, returning the
+    # normalized output and the updated residual, instead of separate add and norm kernels.
+    if (residual is not None) and (fused_add_rms_norm is not None) and hidden_states.is_cuda:
+        return fused_add_rms_norm(hidden_states, residual, norm.weight, None,
+                                  dropout_p=0.0, epsilon=norm.variance_epsilon, prenorm=True)
+
+    if residual is not None:
+        hidden_states = residual + hidden_states
+    return norm(hidden_states), hidden_states
+
+
+_ROTARY_TABLE_CACHE = {}
+
+
+def _rotary_tables(dim, max_seq_len, extend_factor, base):
+    # Shared across model instances with the same config (e.g. multi-model or
+    # multi-LoRA serving); computed once on CPU in fp32.
+    key = (dim, max_seq_len, extend_factor, base)
+    if key not in _ROTARY_TABLE_CACHE:
+        inv_freq = 1.0 / (base ** (torch.arange(0, dim, 2, dtype=torch.float32) / dim))
+
+        t = torch.arange(max_seq_len, dtype=torch.float32)
+        if extend_factor != 1:
+            t = t * extend_factor
+        freqs = torch.outer(t, inv_freq)
+
+        _ROTARY_TABLE_CACHE[key] = (inv_freq, freqs.cos(), freqs.sin())
+
+    return _ROTARY_TABLE_CACHE[key]
+
+
 class UnpaddedLlamaRotaryEmbedding(torch.nn.Module):
-    def __init__(self, dim, max_position_embeddings=2048, extend_context_to=None, base=10000, device=None):
+    def __init__(self, dim, max_position_embeddings=2048, extend_context_to=None, base=10000, device=None, dtype=None):
         super().__init__()
 
         # Extension and calculate factor
@@ -81,42 +174,59 @@ class UnpaddedLlamaRotaryEmbedding(torch.nn.Module):
         print (f"LLaMA context extended from {max_position_embeddings} to {extend_context_to}, factor {self.extend_factor}")
 
         # RoPE
-        inv_freq = 1.0 / (base ** (torch.arange(0, dim, 2).float().to(device) / dim))
-        self.register_buffer("inv_freq", inv_freq)
-
         # Build here to make `torch.jit.trace` work.
         self.max_seq_len_cached = max(max_position_embeddings, extend_context_to)
 
-        t = torch.arange(self.max_seq_len_cached, device=self.inv_freq.device, dtype=self.inv_freq.dtype) * self.extend_factor
-        freqs = torch.einsum("i,j->ij", t, self.inv_freq)
+        inv_freq, freqs_cos, freqs_sin = _rotary_tables(dim, self.max_seq_len_cached, self.extend_factor, base)
+        # Clone: load_state_dict copies into persistent buffers in place, which must
+        # not mutate the shared cached tensor
+        self.register_buffer("inv_freq", inv_freq.clone().to(device))
+
+        # Half layout [max_seq_len, head_dim // 2], as expected by the fused rotary kernel.
+        # Built once in the compute dtype; as non-persistent buffers they are re-cast by
+        # Module._apply if the model is later .half()/.bfloat16() cast.
+        if dtype is None:
+            dtype = torch.get_default_dtype()
 
-        # Different from paper, but it uses a different permutation in order to obtain the same calculation
-        emb = torch.cat((freqs, freqs), dim=-1)
-        dtype = torch.get_default_dtype()
-        self.register_buffer("cos_cached", emb.cos().to(dtype), persistent=False)
-        self.register_buffer("sin_cached", emb.sin().to(dtype), persistent=False)
+        self.register_buffer("cos_cached", freqs_cos.to(device=device, dtype=dtype), persistent=False)
+        self.register_buffer("sin_cached", freqs_sin.to(device=device, dtype=dtype), persistent=False)
 
     def forward(self):
         return self.cos_cached, self.sin_cached
 
 
-def rotate_half(x):
-    """Rotates half the hidden dims of the input."""
-    x1 = x[..., : x.shape[-1] // 2]
-    x2 = x[..., x.shape[-1] // 2 :]
-    return torch.cat((-x2, x1), dim=-1)
+class ApplyRotaryEmbQKV(torch.autograd.Function):
+    """Rotate the q and k slices of a packed qkv tensor in place.
+
+    A single autograd Function over the whole packed tensor, mirroring
+    flash-attn's ApplyRotaryEmbQKV_: the in-place Triton writes only enter the
+    autograd graph through the returned tensor, and backward applies the
+    inverse (conjugate) rotation to the dq/dk slices."""
+
+    @staticmethod
+    def forward(ctx, qkv, cos, sin, cu_seqlens, max_seqlen):
+        # qkv:      [nnz, 3, num_heads, head_dim]
+        # cos, sin: [max_seq_len, head_dim // 2]
+        apply_rotary(qkv[:, 0], cos, sin, cu_seqlens=cu_seqlens, max_seqlen=max_seqlen, inplace=True)
+        apply_rotary(qkv[:, 1], cos, sin, cu_seqlens=cu_seqlens, max_seqlen=max_seqlen, inplace=True)
 
+        ctx.save_for_backward(cos, sin, cu_seqlens)
+        ctx.max_seqlen = max_seqlen
+        return qkv
 
-def apply_rotary_pos_emb(q, k, cos, sin, position_ids):
-    # q, k:     [nnz, num_heads, head_dim]
-    # position_ids: [nnz]
-    # cos, sin: [max_seq_len, head_dim]
+    @staticmethod
+    def backward(ctx, dqkv):
+        cos, sin, cu_seqlens = ctx.saved_tensors
 
-    cos = cos[position_ids].unsqueeze(-2)  # [nnz, 1, head_dim]
-    sin = sin[position_ids].unsqueeze(-2)  # [nnz, 1, head_dim]
-    q_embed = (q * cos) + (rotate_half(q) * sin)
-    k_embed = (k * cos) + (rotate_half(k) * sin)
-    return q_embed, k_embed
+        apply_rotary(dqkv[:, 0], cos, sin, cu_seqlens=cu_seqlens, max_seqlen=ctx.max_seqlen, inplace=True, conjugate=True)
+        apply_rotary(dqkv[:, 1], cos, sin, cu_seqlens=cu_seqlens, max_seqlen=ctx.max_seqlen, inplace=True, conjugate=True)
+        return dqkv, None, None, None, None
+
+
+def apply_rotary_pos_emb_qkv(qkv, cos, sin, cu_seqlens, max_seqlen):
+    # Single fused gather + rotate + write kernel per slice.
+    # Per-sequence positions are derived from cu_seqlens inside the kernel.
+    return ApplyRotaryEmbQKV.apply(qkv, cos, sin, cu_seqlens, max_seqlen)
 
 
 class UnpaddedLlamaMLP(nn.Module):
@@ -127,13 +237,35 @@ class UnpaddedLlamaMLP(nn.Module):
         hidden_act: str,
     ):
         super().__init__()
-        self.gate_proj = nn.Linear(hidden_size, intermediate_size, bias=False)
-        self.down_proj = nn.Linear(intermediate_size, hidden_size, bias=False)
-        self.up_proj = nn.Linear(hidden_size, intermediate_size, bias=False)
-        self.act_fn = ACT2FN[hidden_act]
+        assert hidden_act == "silu", "Fused SwiGLU MLP only supports silu activation."
+
+        self.intermediate_size = intermediate_size
+        # gate_proj and up_proj fused into a single GEMM, reading the input once
+        self.gate_up_proj = nn.Linear(hidden_size, 2 * intermediate_size, bias=False)
+        self.down_proj    = nn.Linear(intermediate_size, hidden_size, bias=False)
+
+        self._register_state_dict_hook(self._split_gate_up_hook)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Fuse separate gate_proj / up_proj weights from HF checkpoints
+        gate_weight = state_dict.pop(prefix + "gate_proj.weight", None)
+        up_weight   = state_dict.pop(prefix + "up_proj.weight", None)
+        if (gate_weight is not None) and (up_weight is not None):
+            state_dict[prefix + "gate_up_proj.weight"] = torch.cat((gate_weight, up_weight), dim=0)
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    @staticmethod
+    def _split_gate_up_hook(module, state_dict, prefix, local_metadata):
+        # Split the fused weight back so saved checkpoints stay standard HF-LLaMA.
+        # State-dict hooks run after the whole subtree is serialized, so the child
+        # Linear's key is present here.
+        gate_up_weight = state_dict.pop(prefix + "gate_up_proj.weight")
+        state_dict[prefix + "gate_proj.weight"], state_dict[prefix + "up_proj.weight"] = gate_up_weight.chunk(2, dim=0)
 
     def forward(self, x):
-        return self.down_proj(self.act_fn(self.gate_proj(x)) * self.up_proj(x))
+        gate, up = self.gate_up_proj(x).split(self.intermediate_size, dim=-1)
+        return self.down_proj(swiglu(gate, up))
 
 
 class UnpaddedLlamaAttention(nn.Module):
@@ -153,37 +285,51 @@ class UnpaddedLlamaAttention(nn.Module):
                 f" and `num_heads`: {self.num_heads})."
             )
 
-        self.q_proj = nn.Linear(self.hidden_size, self.num_heads * self.head_dim, bias=False)
-        self.k_proj = nn.Linear(self.hidden_size, self.num_heads * self.head_dim, bias=False)
-        self.v_proj = nn.Linear(self.hidden_size, self.num_heads * self.head_dim, bias=False)
-        self.o_proj = nn.Linear(self.num_heads * self.head_dim, self.hidden_size, bias=False)
+        # q_proj, k_proj, v_proj fused into a single GEMM, reading the input once
+        self.qkv_proj = nn.Linear(self.hidden_size, 3 * self.num_heads * self.head_dim, bias=False)
+        self.o_proj   = nn.Linear(self.num_heads * self.head_dim, self.hidden_size, bias=False)
+
+        self._register_state_dict_hook(self._split_qkv_hook)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Fuse separate q_proj / k_proj / v_proj weights from HF checkpoints
+        q_weight = state_dict.pop(prefix + "q_proj.weight", None)
+        k_weight = state_dict.pop(prefix + "k_proj.weight", None)
+        v_weight = state_dict.pop(prefix + "v_proj.weight", None)
+        if (q_weight is not None) and (k_weight is not None) and (v_weight is not None):
+            state_dict[prefix + "qkv_proj.weight"] = torch.cat((q_weight, k_weight, v_weight), dim=0)
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    @staticmethod
+    def _split_qkv_hook(module, state_dict, prefix, local_metadata):
+        # Split the fused weight back so saved checkpoints stay standard HF-LLaMA.
+        # State-dict hooks run after the whole subtree is serialized, so the child
+        # Linear's key is present here.
+        qkv_weight = state_dict.pop(prefix + "qkv_proj.weight")
+        state_dict[prefix + "q_proj.weight"], state_dict[prefix + "k_proj.weight"], state_dict[prefix + "v_proj.weight"] = qkv_weight.chunk(3, dim=0)
 
     def forward(
         self,
         cos_sin: Tuple[torch.Tensor, torch.Tensor],
         # Unpadded inputs
         nz_hidden_states: torch.Tensor,
-        nz_position_ids: torch.LongTensor,
         cu_seqlens: torch.Tensor,
         max_seqlen: torch.Tensor
     ) -> torch.Tensor:
         # nz_hidden_states: [nnz, num_heads, head_dim]
-        # nz_position_ids:  [nnz]
         # cu_seqlens:       [bs + 1]
 
-        query_states = self.q_proj(nz_hidden_states).view(-1, self.num_heads, self.head_dim)
-        key_states = self.k_proj(nz_hidden_states).view(-1,   self.num_heads, self.head_dim)
-        value_states = self.v_proj(nz_hidden_states).view(-1, self.num_heads, self.head_dim)
+        qkv_states = self.qkv_proj(nz_hidden_states).view(-1, 3, self.num_heads, self.head_dim)
 
         # RoPE
         cos, sin = cos_sin
-        query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, nz_position_ids)
+        qkv_states = apply_rotary_pos_emb_qkv(qkv_states, cos, sin, cu_seqlens, max_seqlen)
 
-        # flash attn
-        attn_output = flash_attn_unpadded_func(
-            q=query_states, k=key_states, v=value_states,
-            cu_seqlens_q=cu_seqlens, cu_seqlens_k=cu_seqlens,
-            max_seqlen_q=max_seqlen, max_seqlen_k=max_seqlen,
+        # flash attn, packed [nnz, 3, num_heads, head_dim] layout
+        attn_output = flash_attn_varlen_qkvpacked_func(
+            qkv_states,
+            cu_seqlens=cu_seqlens, max_seqlen=max_seqlen,
             dropout_p=0.0, causal=True)
 
         # attn_output: [total_nnz, num_heads, head_dim]
@@ -210,32 +356,41 @@ class UnpaddedLlamaDecoderLayer(nn.Module):
         cos_sin: Tuple[torch.Tensor, torch.Tensor],
         # Unpadded inputs
         nz_hidden_states: torch.Tensor,
-        nz_position_ids: torch.Tensor,
+        nz_residual: Optional[torch.Tensor],
         cu_seqlens: torch.Tensor,
-        max_seqlen: torch.Tensor
-    ) -> Tuple[torch.FloatTensor, Optional[Tuple[torch.FloatTensor, torch.FloatTensor]]]:
-        # Self Attention
-        residual = nz_hidden_states
+        max_seqlen: torch.Tensor,
+        checkpoint_attention: bool = False
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # Residual adds are fused into the layernorms; the pending residual is
+        # threaded alongside the hidden states (None for the first layer).
 
-        nz_hidden_states = self.input_layernorm(nz_hidden_states)
-        nz_hidden_states = self.self_attn(
-            cos_sin=cos_sin,
+        # Self Attention
+        nz_hidden_states, nz_residual = add_rms_norm(nz_hidden_states, nz_residual, self.input_layernorm)
+        if checkpoint_attention:
+            # Selective activation checkpointing: recompute only the attention block
+            nz_hidden_states = torch.utils.checkpoint.checkpoint(
+                self.self_attn,
+
+                cos_sin,
+                nz_hidden_states,
+                cu_seqlens,
+                max_seqlen,
+                use_reentrant=False
+            )
+        else:
+            nz_hidden_states = self.self_attn(
+                cos_sin=cos_sin,
 
-            nz_hidden_states=nz_hidden_states,
-            nz_position_ids=nz_position_ids,
-            cu_seqlens=cu_seqlens,
-            max_seqlen=max_seqlen
-        )
-        nz_hidden_states = residual + nz_hidden_states
+                nz_hidden_states=nz_hidden_states,
+                cu_seqlens=cu_seqlens,
+                max_seqlen=max_seqlen
+            )
 
         # Fully Connected
-        residual = nz_hidden_states
-
-        nz_hidden_states = self.post_attention_layernorm(nz_hidden_states)
+        nz_hidden_states, nz_residual = add_rms_norm(nz_hidden_states, nz_residual, self.post_attention_layernorm)
         nz_hidden_states = self.mlp(nz_hidden_states)
-        nz_hidden_states = residual + nz_hidden_states
 
-        return nz_hidden_states
+        return nz_hidden_states, nz_residual
 
 
 class UnpaddedLlamaPreTrainedModel(PreTrainedModel):
@@ -268,11 +423,16 @@ class UnpaddedLlamaModel(UnpaddedLlamaPreTrainedModel):
         config: LlamaConfig
     """
 
-    def __init__(self, config: LlamaConfig, extend_context_to=None):
+    def __init__(self, config: LlamaConfig, extend_context_to=None, selective_checkpointing=False):
         super().__init__(config)
         self.padding_idx = config.pad_token_id
         self.vocab_size = config.vocab_size
 
+        # Selective activation checkpointing: recompute only attention on backward,
+        # keeping MLP activations. Attention recompute is cheap with FlashAttention
+        # while MLP recompute costs two large GEMMs.
+        self.selective_checkpointing = selective_checkpointing
+
         self.embed_tokens = nn.Embedding(config.vocab_size, config.hidden_size, self.padding_idx)
         self.rotary_emb   = UnpaddedLlamaRotaryEmbedding(config.hidden_size // config.num_attention_heads,
                                                          max_position_embeddings=config.max_position_embeddings,
@@ -293,23 +453,37 @@ class UnpaddedLlamaModel(UnpaddedLlamaPreTrainedModel):
 
     def forward(
         self,
-        # Unpadded inputs
+        # Unpadded inputs. Rotary positions are per-sequence aranges derived from cu_seqlens.
         nz_input_ids: torch.Tensor,
-        nz_position_ids: torch.Tensor,
         cu_seqlens: torch.Tensor,
         max_seqlen: torch.Tensor,
     ) -> torch.Tensor:
         nz_hidden_states = self.embed_tokens(nz_input_ids)
+        nz_residual      = None
         cos_sin          = self.rotary_emb()
 
         # decoder layers
         for decoder_layer in self.layers:
             if self.gradient_checkpointing and self.training:
+                if self.selective_checkpointing:
+                    nz_hidden_states, nz_residual = decoder_layer(
+                        cos_sin=cos_sin,
+
+                        nz_hidden_states=nz_hidden_states,
+                        nz_residual=nz_residual,
+                        cu_seqlens=cu_seqlens,
+                        max_seqlen=max_seqlen,
+                        checkpoint_attention=True
+                    )
+                    continue
 
                 def create_custom_forward(module):
                     def custom_forward(*inputs):
-                        # None for past_key_value
-                        return module(*inputs)
+                        # Fold the pending residual before returning, so a single
+                        # [nnz, hidden] tensor crosses (and is saved at) the
+                        # checkpoint boundary instead of a hidden/residual pair
+                        nz_hidden_states, nz_residual = module(*inputs)
+                        return nz_hidden_states + nz_residual
 
                     return custom_forward
 
@@ -318,21 +492,23 @@ class UnpaddedLlamaModel(UnpaddedLlamaPreTrainedModel):
 
                     cos_sin,
                     nz_hidden_states,
-                    nz_position_ids,
+                    nz_residual,
                     cu_seqlens,
                     max_seqlen
                 )
+                nz_residual = None
             else:
-                nz_hidden_states = decoder_layer(
+                nz_hidden_states, nz_residual = decoder_layer(
                     cos_sin=cos_sin,
-                    
+
                     nz_hidden_states=nz_hidden_states,
-                    nz_position_ids=nz_position_ids,
+                    nz_residual=nz_residual,
                     cu_seqlens=cu_seqlens,
                     max_seqlen=max_seqlen
                 )
 
-        nz_hidden_states = self.norm(nz_hidden_states)
+        # Final residual add fused into the last norm
+        nz_hidden_states, _ = add_rms_norm(nz_hidden_states, nz_residual, self.norm)
 
         return nz_hidden_states
 
@@ -341,12 +517,19 @@ class UnpaddedLlamaForCausalLM(UnpaddedLlamaPreTrainedModel):
     _tied_weights_keys = ["lm_head.weight"]
     # FIXME: LLaMA does not tie embeddings?
 
-    def __init__(self, config, extend_context_to=None):
+    def __init__(self, config, extend_context_to=None, torch_compile=False, selective_checkpointing=False):
         super().__init__(config)
-        self.model = UnpaddedLlamaModel(config, extend_context_to=extend_context_to)
+        self.model = UnpaddedLlamaModel(config, extend_context_to=extend_context_to,
+                                        selective_checkpointing=selective_checkpointing)
 
         self.lm_head = nn.Linear(config.hidden_size, config.vocab_size, bias=False)
 
+        # Optionally compile the decoder stack to fuse pointwise ops and cut launch overhead.
+        # Compile the bound forward (not the module) so state_dict keys keep their names.
+        self.torch_compile = torch_compile
+        if torch_compile:
+            self.model.forward = torch.compile(self.model.forward, mode="reduce-overhead", fullgraph=False)
+
         # Initialize weights and apply final processing
         self.post_init()
 
@@ -370,30 +553,34 @@ class UnpaddedLlamaForCausalLM(UnpaddedLlamaPreTrainedModel):
     
     def forward(
         self,
-        # Unpadded inputs
+        # Unpadded inputs. Rotary positions are per-sequence aranges derived from cu_seqlens.
         nz_input_ids: torch.Tensor,
-        nz_position_ids: torch.Tensor,
         cu_seqlens: torch.Tensor,
         max_seqlen: torch.Tensor,
         # Unpadded labels
         nz_shifted_label_ids: Optional[torch.Tensor] = None,
         nz_shifted_loss_weights:      Optional[torch.Tensor] = None
     ) -> CausalLMOutputWithPast:
+        if self.torch_compile:
+            # Token count and batch size vary per step; mark them dynamic to avoid recompiles
+            torch._dynamo.mark_dynamic(nz_input_ids, 0)
+            torch._dynamo.mark_dynamic(cu_seqlens, 0)
+
         # Model logits
         hidden_states = self.model(
             nz_input_ids=nz_input_ids,
-            nz_position_ids=nz_position_ids,
             cu_seqlens=cu_seqlens,
             max_seqlen=max_seqlen
         )
-        logits = self.lm_head(hidden_states)
 
-        loss = None
+        loss   = None
+        logits = None
         if nz_shifted_label_ids is not None:
-            if nz_shifted_loss_weights is not None:
-                loss = weighted_cross_entropy(logits, nz_shifted_label_ids, nz_shifted_loss_weights)
-            else:
-                loss = CrossEntropyLoss()(logits, nz_shifted_label_ids)
+            # Chunked lm_head + loss, do not materialize full logits
+            loss = chunked_cross_entropy(hidden_states, self.lm_head.weight,
+                                         nz_shifted_label_ids, nz_shifted_loss_weights)
+        else:
+            logits = self.lm_head(hidden_states)
 
         return CausalLMOutputWithPast(
             loss=loss,
@@ -409,34 +596,37 @@ class LlamaForCausalLM(UnpaddedLlamaForCausalLM):
         input_ids: torch.Tensor,
         attention_mask: torch.Tensor,
         position_ids: Optional[torch.Tensor] = None,
+        return_unpadded: bool = False,
         # unused
         return_dict: bool = True,
         output_attentions: bool = False,
         output_hidden_states: bool = False
     ):
         batch_size, seq_len = input_ids.shape
-        if position_ids is None:
-            position_ids = attention_mask.long().cumsum(-1) - 1
-            position_ids.masked_fill_(attention_mask == 0, 0)
+        if position_ids is not None:
+            # Rotary positions are always the per-sequence aranges derived from attention_mask
+            # (identical to the mask cumsum over the kept tokens); anything else is unsupported.
+            raise NotImplementedError("Custom position_ids are not supported, positions derive from attention_mask.")
 
-        # get indices
-        seqlens_in_batch = attention_mask.sum(dim=-1, dtype=torch.int32)
-        indices = torch.nonzero(attention_mask.flatten(), as_tuple=False).flatten()
-        max_seqlen_in_batch = seqlens_in_batch.max().item()
-        cu_seqlens = torch.nn.functional.pad(torch.cumsum(seqlens_in_batch, dim=0, dtype=torch.torch.int32), (1, 0))
+        # Unpad inputs. unpad_input batches the mask reductions, index calculation and
+        # gather into flash-attn's fused helpers instead of ~8 sequential kernels.
+        nz_input_ids, indices, cu_seqlens, max_seqlen_in_batch = unpad_input(input_ids.unsqueeze(-1), attention_mask)
 
-        # Unpad inputs
-        nz_input_ids    = torch.take_along_dim(input_ids,    indices)
-        nz_position_ids = torch.take_along_dim(position_ids, indices)
+        nz_input_ids = nz_input_ids.squeeze(-1)
 
         # Unpadded forward
         logits = super().forward(
             nz_input_ids=nz_input_ids,
-            nz_position_ids=nz_position_ids,
             cu_seqlens=cu_seqlens,
             max_seqlen=max_seqlen_in_batch
         ).logits
 
+        # Callers that consume per-token logits can skip re-padding, which allocates
+        # and scatters a full [batch, seq_len, vocab] tensor
+        if return_unpadded:
+            return UnpaddedCausalLMOutput(logits=logits,
+                                          indices=indices, cu_seqlens=cu_seqlens, max_seqlen=max_seqlen_in_batch)
+
         # Pad logits
         logits = pad_input(logits, indices, batch_size, seq_len)
 
@@ -447,6 +637,5 @@ class LlamaForCausalLM(UnpaddedLlamaForCausalLM):
                                       **kwargs):
         return {
             "input_ids": input_ids,
-            "attention_mask": kwargs.get("attention_mask"),
-            "position_ids": kwargs.get("position_ids")
+            "attention_mask": kwargs.get("attention_mask")
         }
@@ -91,12 +91,14 @@ def batch_to_tensor(batch, group_loss_weights, dtype=torch.long, loss_dtype=torc
     batch_lengths = torch.tensor([len(token_list) for (token_list, mask_list, group) in batch], dtype=torch.int32, device="cpu")
 
     max_seqlen    = torch.max(batch_lengths)
-    cu_seqlens    = torch.nn.functional.pad(batch_lengths.cumsum(-1, dtype=torch.int32), (1, 0))
+
+    # Write the cumsum into a preallocated pinned buffer instead of pad-ing a new allocation
+    cu_seqlens    = torch.zeros((len(batch) + 1, ), dtype=torch.int32, pin_memory=True, device="cpu")
+    torch.cumsum(batch_lengths, -1, dtype=torch.int32, out=cu_seqlens[1:])
 
     # nz elements
     nz_num               = cu_seqlens[-1]
     nz_input_ids         = torch.zeros((nz_num, ), dtype=dtype, pin_memory=True, device="cpu")
-    nz_position_ids      = torch.zeros((nz_num, ), dtype=dtype, pin_memory=True, device="cpu")
     nz_shifted_label_ids = torch.zeros((nz_num, ), dtype=dtype, pin_memory=True, device="cpu")
 
     nz_shifted_loss_weights = None
@@ -109,15 +111,13 @@ def batch_to_tensor(batch, group_loss_weights, dtype=torch.long, loss_dtype=torc
 
         tokens       = torch.tensor(token_list, dtype=dtype,      device="cpu")
         masks        = torch.tensor(mask_list,  dtype=torch.bool, device="cpu")
-        position_ids = torch.arange(length,     dtype=dtype,      device="cpu")
 
         shifted_label_ids = torch.where(masks, tokens, IGNORE_LABEL_ID)
         shifted_label_ids = torch.nn.functional.pad(shifted_label_ids[1:], (0, 1), "constant", IGNORE_LABEL_ID)
 
         nz_input_ids[index: index + length]         = tokens
-        nz_position_ids[index: index + length]      = position_ids
         nz_shifted_label_ids[index: index + length] = shifted_label_ids
-        
+
         if group_loss_weights is not None:
             shifted_loss_weights = masks * torch.full((length, ), group_loss_weights[group], dtype=loss_dtype, device="cpu")
             shifted_loss_weights = torch.nn.functional.pad(shifted_loss_weights[1:], (0, 1), "constant", 0)
@@ -130,7 +130,6 @@ def batch_to_tensor(batch, group_loss_weights, dtype=torch.long, loss_dtype=torc
     return dict(max_seqlen=max_seqlen,
                 cu_seqlens=cu_seqlens,
                 nz_input_ids=nz_input_ids,
-                nz_position_ids=nz_position_ids, 
                 nz_shifted_label_ids=nz_shifted_label_ids,
                 nz_shifted_loss_weights=nz_shifted_loss_weights)
 